@@ -4,29 +4,670 @@ import os
 from dotenv import load_dotenv
 import requests
 import json
+import logging
 import re
-from datetime import datetime, timedelta
+import sys
+import math
+import bisect
+import unicodedata
+import time
+import tempfile
+import threading
+from collections import Counter, OrderedDict, deque
+from datetime import date, datetime, timedelta
 
 # .envファイルを読み込む
 load_dotenv()
 
+# バックグラウンドスレッドなど画面に表示できないエラーの出力先
+logger = logging.getLogger(__name__)
+
 # OpenAI APIキーを設定
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 # 楽天API設定
 RAKUTEN_APP_ID = os.getenv("RAKUTEN_APP_ID")
+RAKUTEN_VACANT_HOTEL_SEARCH_URL = "https://app.rakuten.co.jp/services/api/Travel/VacantHotelSearch/20170426"
+# レスポンス形式（2: 階層の浅いコンパクト形式）
+RAKUTEN_FORMAT_VERSION = 2
+# 取得する項目（表示・既知ホテルの索引・入力候補に必要なものだけに絞る）
+RESULT_PAGING_FIELDS = ['recordCount', 'pageCount', 'page', 'first', 'last']
+RESULT_HOTEL_FIELDS = [
+    'hotelNo', 'hotelName', 'hotelKanaName', 'hotelSpecial', 'hotelMinCharge',
+    'latitude', 'longitude', 'address1', 'address2', 'access',
+    'hotelInformationUrl', 'planListUrl', 'hotelImageUrl',
+    'reviewAverage', 'reviewCount'
+]
+# ページング情報 + ホテル基本情報 + 料金情報（dailyCharge.total）
+RAKUTEN_RESPONSE_ELEMENTS = RESULT_PAGING_FIELDS + RESULT_HOTEL_FIELDS + ['total']
+# 楽天APIの呼び出し上限（回/秒）
+RAKUTEN_RATE_LIMIT_PER_SECOND = float(os.getenv("RAKUTEN_RATE_LIMIT_PER_SECOND", "1"))
 
 # Google Geocoding API設定
 GOOGLE_GEOCODING_API_KEY = os.getenv("GOOGLE_GEOCODING_API_KEY")
+GOOGLE_GEOCODING_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+
+# 検索全体のデッドライン（秒）と各ステージへの配分
+SEARCH_DEADLINE_SECONDS = float(os.getenv("SEARCH_DEADLINE_SECONDS", "12"))
+SEARCH_STAGE_SHARES = {
+    'parse': 0.4,    # OpenAIによる条件解析
+    'geocode': 0.25, # 地名から緯度経度への変換
+    'search': 1.0    # 楽天API呼び出し（残り時間すべて）
+}
+# デッドラインなしで呼び出された場合の上流APIタイムアウト（秒）
+DEFAULT_REQUEST_TIMEOUT = 10
+# 残り時間がこれ未満なら上流を呼ばずにフォールバックする（秒）
+MIN_REQUEST_TIMEOUT = 0.2
+
+# サーキットブレーカー設定
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_FAILURE_THRESHOLD", "3"))
+CIRCUIT_BREAKER_RESET_SECONDS = float(os.getenv("CIRCUIT_BREAKER_RESET_SECONDS", "30"))
+
+# フォールバック用キャッシュ設定
+GEOCODE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+GEOCODE_CACHE_MAX_ENTRIES = 5000
+RESULT_CACHE_TTL_SECONDS = 15 * 60
+STALE_RESULT_MAX_AGE_SECONDS = 6 * 3600
+# 全セッションで共有する検索結果ストアのメモリ上限（MB）
+RESULT_STORE_MAX_BYTES = int(float(os.getenv("RESULT_STORE_MAX_MB", "64")) * 1024 * 1024)
+
+# 条件が指定されていない場合の既定値（詳細検索フォーム・条件解析・キャッシュウォーマーで共通）
+DEFAULT_ADULT_NUM = 2
+DEFAULT_SEARCH_RADIUS = 1  # km
+
+# キャッシュウォーマー設定
+CACHE_WARMER_ENABLED = os.getenv("CACHE_WARMER_ENABLED", "1") == "1"
+CACHE_WARMER_INTERVAL_SECONDS = float(os.getenv("CACHE_WARMER_INTERVAL_SECONDS", "600"))
+# 常にウォームアップする地名（カンマ区切り）
+CACHE_WARMER_LOCATIONS = [name.strip() for name in os.getenv("CACHE_WARMER_LOCATIONS", "").split(",") if name.strip()]
+# 最近の検索から学習する人気クエリの件数と集計期間
+CACHE_WARMER_TOP_QUERIES = int(os.getenv("CACHE_WARMER_TOP_QUERIES", "5"))
+CACHE_WARMER_TRAFFIC_WINDOW_SECONDS = 24 * 3600
+# ウォームアップ対象とする直近の週末の数
+CACHE_WARMER_WEEKENDS = int(os.getenv("CACHE_WARMER_WEEKENDS", "3"))
+# バックグラウンド処理は上限の何倍の間隔を空けて呼び出すか（対話的検索に枠を譲る）
+CACHE_WARMER_RATE_FACTOR = 3
+# 検索クエリの傾向を表すパラメータ（日付以外）
+QUERY_KEY_PARAMS = ['location', 'adultNum', 'childNum', 'searchRadius', 'maxCharge', 'minCharge']
+
+# 既知のホテル情報（hotelBasicInfo）の保存先と空間インデックス設定
+KNOWN_HOTELS_PATH = os.getenv("KNOWN_HOTELS_PATH", "known_hotels.json")
+# グリッドのセルサイズ（日本測地系・秒、60秒 ≒ 緯度方向1.85km）
+HOTEL_INDEX_CELL_SECONDS = 60
+# 距離計算用: 緯度1秒あたりの距離（km）
+KM_PER_LATITUDE_SECOND = 6371.0 * math.pi / 180 / 3600
+# 楽天APIで取得する項目のうち、料金など検索ごとに変わる情報を除いたものを保存
+KNOWN_HOTEL_FIELDS = [key for key in RESULT_HOTEL_FIELDS if key != 'hotelMinCharge']
+# 新規ホテル追加後、ファイルに保存するまでの待ち時間（秒、この間の追加はまとめて保存）
+HOTEL_INDEX_SAVE_DELAY_SECONDS = 5
+# 検索前に表示する既知の近隣ホテルの最大件数
+NEARBY_PREVIEW_LIMIT = 10
+
+# 地域名の入力候補の最大件数と、1回の検索で走査するキーの上限
+SUGGESTION_LIMIT = 8
+SUGGESTION_SCAN_LIMIT = 200
+
+# APIに送信しない内部パラメータ
+INTERNAL_PARAM_KEYS = ['coordinate_match', 'coordinate_failed', 'parser']
+
+# ローカル解析で認識する地域名
+KNOWN_LOCATIONS = ['東京', '大阪', '京都', '沖縄', '北海道', '箱根', '熱海']
+
+class Deadline:
+    """検索フロー全体の締め切り時刻を管理し、ステージごとの持ち時間を切り出す"""
+
+    def __init__(self, seconds):
+        self.total = max(0.0, seconds)
+        self.expires_at = time.monotonic() + self.total
+
+    def remaining(self):
+        """残り時間（秒）"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def stage(self, name):
+        """ステージ用のデッドラインを作成（全体の残り時間を超えない）"""
+        share = SEARCH_STAGE_SHARES.get(name, 1.0)
+        return Deadline(min(self.remaining(), self.total * share))
+
+class CircuitBreaker:
+    """上流APIごとのサーキットブレーカー（連続失敗でオープンし、一定時間後に再試行を許可）"""
+
+    def __init__(self, name, failure_threshold, reset_seconds):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        """上流を呼び出してよいか判定（オープン中、およびハーフオープンで試行中の場合はFalse）
+
+        Trueを受け取った呼び出し元は、必ずrecord_successかrecord_failureで結果を記録すること。
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.state == 'open':
+                if now - self.opened_at < self.reset_seconds:
+                    return False
+                # 一定時間経過したらハーフオープンにして1件だけ試行を許可
+                self.state = 'half_open'
+                self.probe_started_at = now
+                return True
+            if self.state == 'half_open':
+                # 試行中は他の呼び出しを拒否（試行が結果を記録しないまま一定時間経った場合は再試行を許可）
+                if now - self.probe_started_at < self.reset_seconds:
+                    return False
+                self.probe_started_at = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.opened_at = None
+            self.probe_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.probe_started_at = None
+
+class TTLCache:
+    """セッション間で共有するスレッドセーフな有効期限付きキャッシュ（件数上限を超えると古い順に削除）"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, max_age=None):
+        """キャッシュを取得（max_age秒より古い場合はNone）"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if max_age is not None and time.time() - stored_at > max_age:
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def items(self, max_age=None):
+        """有効なキャッシュの (キー, 値) のリスト"""
+        threshold = None if max_age is None else time.time() - max_age
+        with self._lock:
+            return [(key, value) for key, (stored_at, value) in self._data.items()
+                    if threshold is None or stored_at >= threshold]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+class HotelSpatialIndex:
+    """既知のホテル情報をhotelNoで保持し、日本測地系・秒のグリッドで近傍検索する"""
+
+    def __init__(self, path=None, cell_seconds=HOTEL_INDEX_CELL_SECONDS):
+        self.path = path
+        self.cell_seconds = cell_seconds
+        self._hotels = {}
+        self._cells = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+        self.load()
+
+    def __len__(self):
+        return len(self._hotels)
+
+    def _cell(self, latitude, longitude):
+        return (int(latitude // self.cell_seconds), int(longitude // self.cell_seconds))
+
+    def _add_locked(self, hotel_basic_info):
+        """ホテルを追加・更新（新規追加の場合True）"""
+        try:
+            hotel_no = int(hotel_basic_info['hotelNo'])
+            latitude = float(hotel_basic_info['latitude'])
+            longitude = float(hotel_basic_info['longitude'])
+        except (KeyError, TypeError, ValueError):
+            return False
+
+        hotel = {key: hotel_basic_info[key] for key in KNOWN_HOTEL_FIELDS if key in hotel_basic_info}
+        previous = self._hotels.get(hotel_no)
+        if previous is not None:
+            old_cell = self._cell(previous['latitude'], previous['longitude'])
+            self._cells.get(old_cell, set()).discard(hotel_no)
+
+        self._hotels[hotel_no] = hotel
+        self._cells.setdefault(self._cell(latitude, longitude), set()).add(hotel_no)
+        return previous is None
+
+    def add_results(self, results):
+        """楽天APIレスポンス内のホテルを登録（新規ホテルがあればバックグラウンドで保存）"""
+        with self._lock:
+            added = 0
+            for hotel_basic_info, _ in normalize_hotel_results(results):
+                if self._add_locked(hotel_basic_info):
+                    added += 1
+        if added:
+            self.schedule_save()
+        return added
+
+    def hotels(self):
+        """登録済みのホテル情報のリスト"""
+        with self._lock:
+            return list(self._hotels.values())
+
+    def nearby(self, latitude, longitude, radius_km, limit=None):
+        """指定地点から半径radius_km以内のホテルを近い順に返す [(距離km, ホテル情報), ...]"""
+        lat_span = radius_km / KM_PER_LATITUDE_SECOND
+        cos_lat = max(math.cos(math.radians(latitude / 3600)), 0.01)
+        lng_span = lat_span / cos_lat
+
+        min_cell = self._cell(latitude - lat_span, longitude - lng_span)
+        max_cell = self._cell(latitude + lat_span, longitude + lng_span)
+
+        found = []
+        with self._lock:
+            for lat_cell in range(min_cell[0], max_cell[0] + 1):
+                for lng_cell in range(min_cell[1], max_cell[1] + 1):
+                    for hotel_no in self._cells.get((lat_cell, lng_cell), ()):
+                        hotel = self._hotels[hotel_no]
+                        distance = distance_km(latitude, longitude, hotel['latitude'], hotel['longitude'])
+                        if distance <= radius_km:
+                            found.append((distance, hotel))
+
+        found.sort(key=lambda item: item[0])
+        return found[:limit] if limit else found
+
+    def load(self):
+        """保存済みのホテル情報を読み込む"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                hotels = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("既知ホテル情報の読み込みエラー: %s", e)
+            return
+        with self._lock:
+            for hotel in hotels:
+                self._add_locked(hotel)
+
+    def schedule_save(self):
+        """保存を予約（検索を待たせないよう、一定時間後にバックグラウンドでまとめて書き込む）"""
+        if not self.path:
+            return
+        with self._lock:
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(HOTEL_INDEX_SAVE_DELAY_SECONDS, self._flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def _flush(self):
+        # 予約を解除してから保存する（保存中の追加は次の予約で書き込まれる）
+        with self._lock:
+            self._save_timer = None
+        self.save()
+
+    def save(self):
+        """ホテル情報をファイルに保存（書き込みごとに別の一時ファイルに書いてから置き換える）"""
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                hotels = list(self._hotels.values())
+            tmp_path = None
+            try:
+                with tempfile.NamedTemporaryFile(
+                    'w', encoding='utf-8', delete=False, suffix='.tmp',
+                    dir=os.path.dirname(os.path.abspath(self.path)),
+                    prefix=f"{os.path.basename(self.path)}."
+                ) as f:
+                    tmp_path = f.name
+                    json.dump(hotels, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                logger.exception("既知ホテル情報の保存エラー")
+                if tmp_path and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+# カタカナ（ァ〜ヶ）→ ひらがなの変換表
+KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(ord('ァ'), ord('ヶ') + 1)}
+
+def normalize_suggestion_text(text):
+    """入力候補の照合用に文字列を正規化（全角半角・大文字小文字・空白を統一し、カタカナをひらがなに変換）"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    return ''.join(text.split()).translate(KATAKANA_TO_HIRAGANA)
+
+class LocationSuggester:
+    """地名・ホテル名・ホテル名かなの前方一致インデックス（候補は緯度経度を持つ）"""
+
+    def __init__(self):
+        self._keys = []       # (正規化したキー, 候補ID) の昇順リスト
+        self._entries = {}    # 候補ID -> 候補
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _index_keys(texts):
+        """textsの各文字列とその単語（空白区切り）の正規化キー"""
+        keys = set()
+        for text in texts:
+            if not text:
+                continue
+            words = unicodedata.normalize('NFKC', text).lower().translate(KATAKANA_TO_HIRAGANA).split()
+            keys.add(''.join(words))
+            # 「スーパーホテル　東京駅」のような空白区切りの単語からも検索可能にする
+            keys.update(words)
+        keys.discard('')
+        return keys
+
+    def add(self, entry_id, texts, entry):
+        """候補を1件登録（textsの各文字列とその単語の先頭から検索できるようにする）"""
+        keys = self._index_keys(texts)
+        with self._lock:
+            is_new = entry_id not in self._entries
+            self._entries[entry_id] = entry
+            if is_new:
+                for key in keys:
+                    bisect.insort(self._keys, (key, entry_id))
+
+    def add_many(self, items):
+        """候補をまとめて登録（キーを集めてから1回だけ並べ替える、起動時の構築用）"""
+        new_keys = []
+        with self._lock:
+            for item in items:
+                if item is None:
+                    continue
+                entry_id, texts, entry = item
+                is_new = entry_id not in self._entries
+                self._entries[entry_id] = entry
+                if is_new:
+                    new_keys.extend((key, entry_id) for key in self._index_keys(texts))
+            self._keys.extend(new_keys)
+            self._keys.sort()
+
+    @staticmethod
+    def place_item(location_key, coordinates):
+        """緯度経度キャッシュの地名の (候補ID, 検索用文字列, 候補)"""
+        if coordinates.get('latitude') is None or coordinates.get('longitude') is None:
+            return None
+        return f"place:{location_key}", [location_key, coordinates.get('location_name')], {
+            'kind': 'place',
+            'label': location_key,
+            'location_name': coordinates.get('location_name', location_key),
+            'latitude': coordinates['latitude'],
+            'longitude': coordinates['longitude']
+        }
+
+    @staticmethod
+    def hotel_item(hotel):
+        """既知のホテルの (候補ID, 検索用文字列, 候補)（名前・かな名で検索可能）"""
+        if hotel.get('hotelNo') is None or hotel.get('latitude') is None or hotel.get('longitude') is None:
+            return None
+        return f"hotel:{hotel['hotelNo']}", [hotel.get('hotelName'), hotel.get('hotelKanaName')], {
+            'kind': 'hotel',
+            'label': hotel.get('hotelName', ''),
+            'location_name': f"{hotel.get('address1', '')}{hotel.get('address2', '')}" or hotel.get('hotelName', ''),
+            'latitude': hotel['latitude'],
+            'longitude': hotel['longitude'],
+            'hotelNo': hotel['hotelNo']
+        }
 
-def get_coordinates_from_google_geocoding(location_text):
+    def add_place(self, location_key, coordinates):
+        """緯度経度キャッシュの地名を登録"""
+        item = self.place_item(location_key, coordinates)
+        if item:
+            self.add(*item)
+
+    def add_hotel(self, hotel):
+        """既知のホテルを登録"""
+        item = self.hotel_item(hotel)
+        if item:
+            self.add(*item)
+
+    def suggest(self, text, limit=SUGGESTION_LIMIT):
+        """入力の前方一致候補を返す（地名を優先し、短い名前から順に）
+
+        走査はSUGGESTION_SCAN_LIMIT件まで、地名がlimit件見つかった時点で打ち切る。
+        """
+        prefix = normalize_suggestion_text(text)
+        if not prefix:
+            return []
+
+        entries = {}
+        places = 0
+        with self._lock:
+            keys = self._keys
+            index = bisect.bisect_left(keys, (prefix,))
+            end = min(index + SUGGESTION_SCAN_LIMIT, len(keys))
+            while index < end:
+                key, entry_id = keys[index]
+                if not key.startswith(prefix):
+                    break
+                if entry_id not in entries:
+                    entry = self._entries[entry_id]
+                    entries[entry_id] = entry
+                    # 地名が上限件数そろえば、以降の候補が上位に入ることはない
+                    if entry['kind'] == 'place':
+                        places += 1
+                        if places >= limit:
+                            break
+                index += 1
+
+        ranked = sorted(entries.values(), key=lambda entry: (entry['kind'] != 'place', len(entry['label'])))
+        return ranked[:limit]
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """日本測地系・秒単位の2地点間の距離（km、ハバーサイン公式）"""
+    lat1, lng1, lat2, lng2 = (math.radians(value / 3600) for value in (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371.0 * math.asin(min(1.0, math.sqrt(a)))
+
+@st.cache_resource
+def get_circuit_breaker(name):
+    """上流API名ごとのサーキットブレーカー（プロセス全体で共有）"""
+    return CircuitBreaker(name, CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_RESET_SECONDS)
+
+@st.cache_resource
+def get_geocode_cache():
+    """地名 → 緯度経度のキャッシュ（プロセス全体で共有）"""
+    return TTLCache(GEOCODE_CACHE_MAX_ENTRIES)
+
+def estimate_size(value):
+    """オブジェクトのおおよそのメモリ使用量（バイト、dict・list・tupleの中身を含む）"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+class SharedResultStore:
+    """正規化済みの検索結果を全セッションで共有するストア（メモリ上限を超えると最も古く使われたものから削除）
+
+    保存した結果は読み取り専用として扱い、取得時は共有のホテル情報を参照する軽量なビューを返す。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # キー -> (保存時刻, 結果, バイト数)
+        self._lock = threading.Lock()
+
+    def get(self, key, max_age=None):
+        """保存からの経過秒数と結果のビューを取得（max_age秒より古い場合はNone）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            age = None if entry is None else time.time() - entry[0]
+            if age is None or (max_age is not None and age > max_age):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            record = entry[1]
+        return age, {'pagingInfo': record['pagingInfo'], 'hotels': list(record['hotels'])}
+
+    def age(self, key):
+        """保存からの経過秒数（存在しない場合はNone）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else time.time() - entry[0]
+
+    def set(self, key, record):
+        """結果を保存（上限を超える分は古いものから削除、単独で上限を超える結果は保存しない）"""
+        size = estimate_size(record)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes_used -= previous[2]
+            self._entries[key] = (time.time(), record, size)
+            self.bytes_used += size
+            while self.bytes_used > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.bytes_used -= evicted_size
+                self.evictions += 1
+        return True
+
+    def stats(self):
+        """メモリ使用量・件数などの計測値"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes_used': self.bytes_used,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+class RateLimiter:
+    """上流APIの呼び出し間隔を管理（バックグラウンド処理は対話的検索に枠を譲る）"""
+
+    def __init__(self, calls_per_second):
+        self.min_interval = 1.0 / calls_per_second if calls_per_second > 0 else 0.0
+        self.last_call = 0.0
+        self._lock = threading.Lock()
+
+    def record_call(self):
+        """対話的検索の呼び出しを記録（待機はしない）"""
+        with self._lock:
+            self.last_call = time.monotonic()
+
+    def wait_for_background_slot(self, stop_event, factor=CACHE_WARMER_RATE_FACTOR):
+        """直前の呼び出しから十分な間隔が空くまで待機（停止要求があればFalse）"""
+        while not stop_event.is_set():
+            with self._lock:
+                wait = self.last_call + self.min_interval * factor - time.monotonic()
+                if wait <= 0:
+                    self.last_call = time.monotonic()
+                    return True
+            stop_event.wait(wait)
+        return False
+
+class QueryTraffic:
+    """最近の検索クエリを記録し、人気のクエリキーを求める"""
+
+    def __init__(self, window_seconds):
+        self.window_seconds = window_seconds
+        self._events = deque()
+        self._lock = threading.Lock()
+
+    def record(self, query_key):
+        with self._lock:
+            self._events.append((time.time(), query_key))
+            self._expire()
+
+    def top(self, count):
+        """集計期間内の検索回数が多い順にクエリキーを返す"""
+        with self._lock:
+            self._expire()
+            return [key for key, _ in Counter(key for _, key in self._events).most_common(count)]
+
+    def _expire(self):
+        threshold = time.time() - self.window_seconds
+        while self._events and self._events[0][0] < threshold:
+            self._events.popleft()
+
+@st.cache_resource
+def get_result_store():
+    """正規化済みの楽天API検索結果のストア（プロセス全体で共有）"""
+    return SharedResultStore(RESULT_STORE_MAX_BYTES)
+
+@st.cache_resource
+def get_hotel_index():
+    """既知ホテルの空間インデックス（プロセス全体で共有）"""
+    return HotelSpatialIndex(KNOWN_HOTELS_PATH)
+
+@st.cache_resource
+def get_location_suggester():
+    """地域名の入力候補インデックス（緯度経度キャッシュと既知ホテルから構築、プロセス全体で共有）"""
+    suggester = LocationSuggester()
+    suggester.add_many(
+        [LocationSuggester.place_item(location_key, coordinates) for location_key, coordinates in get_geocode_cache().items()]
+        + [LocationSuggester.hotel_item(hotel) for hotel in get_hotel_index().hotels()]
+    )
+    return suggester
+
+@st.cache_resource
+def get_rakuten_rate_limiter():
+    """楽天APIの呼び出し間隔管理（プロセス全体で共有）"""
+    return RateLimiter(RAKUTEN_RATE_LIMIT_PER_SECOND)
+
+@st.cache_resource
+def get_query_traffic():
+    """最近の検索クエリの記録（プロセス全体で共有）"""
+    return QueryTraffic(CACHE_WARMER_TRAFFIC_WINDOW_SECONDS)
+
+def request_timeout(deadline):
+    """デッドラインから上流API呼び出しのタイムアウト秒数を決定"""
+    if deadline is None:
+        return DEFAULT_REQUEST_TIMEOUT
+    return deadline.remaining()
+
+def is_upstream_failure(error):
+    """サーキットブレーカーで失敗として数えるべきエラーか判定（タイムアウト・接続障害・5xx・429）"""
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError):
+        response = getattr(error, 'response', None)
+        return response is None or response.status_code >= 500 or response.status_code == 429
+    return isinstance(error, (
+        openai.error.Timeout,
+        openai.error.APIConnectionError,
+        openai.error.APIError,
+        openai.error.RateLimitError,
+        openai.error.ServiceUnavailableError,
+        openai.error.TryAgain
+    ))
+
+def get_coordinates_from_google_geocoding(location_text, deadline=None):
     """Google Geocoding APIを使って地名から緯度経度を取得（WGS84・度単位）"""
     if not GOOGLE_GEOCODING_API_KEY:
         return {}
 
+    breaker = get_circuit_breaker('google')
+    timeout = request_timeout(deadline)
+    if timeout < MIN_REQUEST_TIMEOUT or not breaker.allow_request():
+        return {}
+
     try:
         # Google Geocoding API URL
-        url = "https://maps.googleapis.com/maps/api/geocode/json"
+        url = GOOGLE_GEOCODING_URL
         params = {
             'address': location_text + ', Japan',  # 日本国内検索を明示
             'key': GOOGLE_GEOCODING_API_KEY,
@@ -34,11 +675,17 @@ def get_coordinates_from_google_geocoding(location_text):
             'region': 'jp'     # 日本地域を優先
         }
 
-        response = requests.get(url, params=params)
+        response = requests.get(url, params=params, timeout=timeout)
         response.raise_for_status()
 
         data = response.json()
 
+        # 上流側の障害を示すステータスはブレーカーの失敗として数える
+        if data['status'] in ('UNKNOWN_ERROR', 'OVER_QUERY_LIMIT'):
+            breaker.record_failure()
+            return {}
+        breaker.record_success()
+
         if data['status'] == 'OK' and data['results']:
             result = data['results'][0]  # 最初の結果を使用
             location = result['geometry']['location']
@@ -69,26 +716,56 @@ def get_coordinates_from_google_geocoding(location_text):
             return {}
 
     except Exception as e:
+        # 上流は応答している（応答の解析失敗など）場合は成功として記録し、ハーフオープンの試行を終える
+        if is_upstream_failure(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
         st.error(f"Google Geocoding API エラー: {str(e)}")
         return {}
 
-def get_coordinates_from_location(location_text):
-    """地名から緯度経度を取得（Google Geocoding API優先、フォールバックでOpenAI）"""
+def normalize_location_key(location_text):
+    """キャッシュキー用に地名を正規化"""
+    return re.sub(r'\s+', '', location_text or '')
+
+def get_coordinates_from_location(location_text, deadline=None):
+    """地名から緯度経度を取得（キャッシュ優先、次にGoogle Geocoding API、フォールバックでOpenAI）"""
+    cache = get_geocode_cache()
+    cache_key = normalize_location_key(location_text)
+
+    # 座標はほぼ変わらないため、キャッシュがあれば上流を呼ばない
+    cached = cache.get(cache_key, max_age=GEOCODE_CACHE_TTL_SECONDS)
+    if cached:
+        return cached
+
+    coordinates = {}
 
     # 最初にGoogle Geocoding APIを試す
     if GOOGLE_GEOCODING_API_KEY:
-        coordinates = get_coordinates_from_google_geocoding(location_text)
-        if coordinates:
-            return coordinates
+        coordinates = get_coordinates_from_google_geocoding(location_text, deadline)
 
     # Google APIが利用できない場合はOpenAIを使用
-    return get_coordinates_from_openai(location_text)
+    if not coordinates:
+        coordinates = get_coordinates_from_openai(location_text, deadline)
+
+    if coordinates and coordinates.get('latitude') is not None and coordinates.get('longitude') is not None:
+        cache.set(cache_key, coordinates)
+        get_location_suggester().add_place(cache_key, coordinates)
+        return coordinates
+
+    # 上流が使えない場合は期限切れのキャッシュでも利用する
+    return cache.get(cache_key) or coordinates
 
-def get_coordinates_from_openai(location_text):
+def get_coordinates_from_openai(location_text, deadline=None):
     """OpenAIを使って地名から緯度経度を取得（日本測地系・秒単位）- フォールバック用"""
     if not openai.api_key:
         return {}
 
+    breaker = get_circuit_breaker('openai')
+    timeout = request_timeout(deadline)
+    if timeout < MIN_REQUEST_TIMEOUT or not breaker.allow_request():
+        return {}
+
     system_prompt = """
 あなたは地名から緯度経度を取得するアシスタントです。
 
@@ -118,8 +795,10 @@ def get_coordinates_from_openai(location_text):
                 {"role": "user", "content": f"次の地名の緯度経度を日本測地系・秒単位で教えてください: {location_text}"}
             ],
             temperature=0.1,
-            max_tokens=200
+            max_tokens=200,
+            request_timeout=timeout
         )
+        breaker.record_success()
 
         result_text = response.choices[0].message.content
 
@@ -141,6 +820,10 @@ def get_coordinates_from_openai(location_text):
         return {}
 
     except Exception as e:
+        if is_upstream_failure(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
         st.error(f"緯度経度取得エラー: {str(e)}")
         return {}
 
@@ -148,11 +831,130 @@ def format_date_no_padding(date_obj):
     """日付をゼロパディングなしの形式でフォーマット（クロスプラットフォーム対応）"""
     return f"{date_obj.year}-{date_obj.month}-{date_obj.day}"
 
-def parse_travel_request_with_openai(text):
+def apply_coordinates_to_params(params, deadline=None):
+    """パラメータの地名を緯度経度に変換して位置ベース検索用に置き換える"""
+    if 'location' in params and params['location']:
+        coordinates = get_coordinates_from_location(params['location'], deadline)
+        if coordinates and 'latitude' in coordinates and 'longitude' in coordinates:
+            # 緯度経度をパラメータに追加（日本測地系・秒単位、小数点以下2桁まで）
+            # None値のチェックを追加
+            lat_val = coordinates['latitude']
+            lng_val = coordinates['longitude']
+            if lat_val is not None and lng_val is not None:
+                params['latitude'] = round(float(lat_val), 2)
+                params['longitude'] = round(float(lng_val), 2)
+
+            # searchRadiusがない場合はデフォルト値を設定
+            if 'searchRadius' not in params:
+                params['searchRadius'] = DEFAULT_SEARCH_RADIUS
+
+            params['coordinate_match'] = {
+                'original_location': params['location'],
+                'coordinates': coordinates
+            }
+
+            # 緯度経度ベース検索のためlocationフィールドは削除
+            del params['location']
+        else:
+            params['coordinate_failed'] = True
+
+    return params
+
+def parse_travel_request_locally(text):
+    """正規表現で自然言語の入力から検索パラメータを抽出（OpenAIが使えない場合のフォールバック）"""
+    today = datetime.now().date()
+    params = {}
+
+    # 日付処理
+    checkin = None
+    match = re.search(r'(\d{4})\s*[-/年]\s*(\d{1,2})\s*[-/月]\s*(\d{1,2})', text)
+    if match:
+        try:
+            checkin = date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        except ValueError:
+            checkin = None
+    if checkin is None:
+        match = re.search(r'(\d{1,2})\s*(?:月|/)\s*(\d{1,2})\s*日?', text)
+        if match:
+            try:
+                checkin = date(today.year, int(match.group(1)), int(match.group(2)))
+                # 過去の日付は来年として解釈
+                if checkin < today:
+                    checkin = date(today.year + 1, checkin.month, checkin.day)
+            except ValueError:
+                checkin = None
+    if checkin is None:
+        if '明後日' in text:
+            checkin = today + timedelta(days=2)
+        elif '明日' in text:
+            checkin = today + timedelta(days=1)
+        else:
+            checkin = today
+
+    match = re.search(r'(\d+)\s*泊', text)
+    nights = max(1, int(match.group(1))) if match else 1
+    params['checkinDate'] = format_date_no_padding(checkin)
+    params['checkoutDate'] = format_date_no_padding(checkin + timedelta(days=nights))
+
+    # 人数
+    match = re.search(r'大人\s*(\d+)\s*[名人]', text)
+    params['adultNum'] = int(match.group(1)) if match else DEFAULT_ADULT_NUM
+    match = re.search(r'(?:子供|子ども)\s*(\d+)\s*[名人]', text)
+    if match:
+        params['childNum'] = int(match.group(1))
+
+    # 予算
+    match = re.search(r'([\d,]+)\s*円\s*以下', text)
+    if match:
+        params['maxCharge'] = int(match.group(1).replace(',', ''))
+
+    # 検索半径
+    match = re.search(r'(\d+)\s*(?:km|キロ)', text)
+    if match:
+        params['searchRadius'] = min(max(int(match.group(1)), 1), 3)
+
+    # 地域
+    location = next((name for name in KNOWN_LOCATIONS if name in text), None)
+    if location is None:
+        # 日付・人数・予算などの表現を除いた残りから「〜に」「〜周辺」の形の地名を探す
+        remainder = re.sub(
+            r'\d[\d,]*\s*(?:年|月|日|泊|名|人|円\s*以下|km|キロ)?|今日|明日|明後日|大人|子供|子ども|から',
+            ' ', text
+        )
+        match = re.search(r'([^\s、。,/\-にで]+?)(?:周辺|付近|に|で)', remainder)
+        if match:
+            location = match.group(1)
+    if location:
+        params['location'] = location
+
+    params['parser'] = 'local'
+    return params
+
+def parse_travel_request(text, deadline=None):
+    """検索条件を解析（OpenAIが使えない・遅い・障害中の場合はローカル解析にフォールバック）"""
+    if deadline is None:
+        deadline = Deadline(SEARCH_DEADLINE_SECONDS)
+
+    # ブレーカーの判定はparse_travel_request_with_openai内で行う（ハーフオープンの試行枠を二重に取らない）
+    if openai.api_key:
+        params = parse_travel_request_with_openai(text, deadline)
+        if "error" not in params:
+            return params
+
+    params = parse_travel_request_locally(text)
+    return apply_coordinates_to_params(params, deadline.stage('geocode'))
+
+def parse_travel_request_with_openai(text, deadline=None):
     """OpenAI APIを使用して自然言語の入力を楽天トラベルAPIのパラメータに変換"""
     if not openai.api_key:
         return {"error": "OpenAI APIキーが設定されていません"}
 
+    breaker = get_circuit_breaker('openai')
+    parse_deadline = deadline.stage('parse') if deadline else None
+    timeout = request_timeout(parse_deadline)
+    if timeout < MIN_REQUEST_TIMEOUT or not breaker.allow_request():
+        return {"error": "OpenAI API が利用できません"}
+
     # 楽天トラベルAPI用のFunction定義
     functions = [
         {
@@ -202,7 +1004,7 @@ def parse_travel_request_with_openai(text):
                         "description": "検索半径（km）",
                         "minimum": 1,
                         "maximum": 3,
-                        "default": 1
+                        "default": DEFAULT_SEARCH_RADIUS
                     }
                 },
                 "required": []
@@ -230,12 +1032,12 @@ def parse_travel_request_with_openai(text):
 - 地名から日本測地系の緯度経度（秒単位）を取得して位置ベース検索を行います
 
 ### 検索範囲：
-- searchRadius: 検索半径（1-3km、デフォルト1km）
+- searchRadius: 検索半径（1-3km、デフォルト{DEFAULT_SEARCH_RADIUS}km）
 
 ### デフォルト値：
-- 人数が指定されていない場合: adultNum = 2
+- 人数が指定されていない場合: adultNum = {DEFAULT_ADULT_NUM}
 - 泊数が指定されていない場合: 1泊として処理
-- 検索半径が指定されていない場合: searchRadius = 1
+- 検索半径が指定されていない場合: searchRadius = {DEFAULT_SEARCH_RADIUS}
 
 ユーザーの入力から必要なパラメータを抽出し、search_rakuten_hotels関数を呼び出してください。
 """
@@ -249,8 +1051,10 @@ def parse_travel_request_with_openai(text):
             ],
             functions=functions,
             function_call={"name": "search_rakuten_hotels"},
-            temperature=0.1
+            temperature=0.1,
+            request_timeout=timeout
         )
+        breaker.record_success()
 
         # Function callの結果を取得
         function_call = response.choices[0].message.function_call
@@ -258,57 +1062,114 @@ def parse_travel_request_with_openai(text):
             params = json.loads(function_call.arguments)
 
             # 地名が指定されている場合、緯度経度を取得
-            if 'location' in params and params['location']:
-                coordinates = get_coordinates_from_location(params['location'])
-                if coordinates and 'latitude' in coordinates and 'longitude' in coordinates:
-                    # 緯度経度をパラメータに追加（日本測地系・秒単位、小数点以下2桁まで）
-                    # None値のチェックを追加
-                    lat_val = coordinates['latitude']
-                    lng_val = coordinates['longitude']
-                    if lat_val is not None and lng_val is not None:
-                        params['latitude'] = round(float(lat_val), 2)
-                        params['longitude'] = round(float(lng_val), 2)
-
-                    # searchRadiusがない場合はデフォルト値を設定
-                    if 'searchRadius' not in params:
-                        params['searchRadius'] = 2
-
-                    params['coordinate_match'] = {
-                        'original_location': params['location'],
-                        'coordinates': coordinates
-                    }
-
-                    # 緯度経度ベース検索のためlocationフィールドは削除
-                    del params['location']
-                else:
-                    params['coordinate_failed'] = True
-
-            return params
+            geocode_deadline = deadline.stage('geocode') if deadline else None
+            return apply_coordinates_to_params(params, geocode_deadline)
         else:
             return {"error": "パラメータの抽出に失敗しました"}
 
     except Exception as e:
+        if is_upstream_failure(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
         return {"error": f"OpenAI API エラー: {str(e)}"}
 
-def search_rakuten_hotels(params):
-    """楽天トラベル空室検索APIを呼び出す（緯度経度ベース）"""
-    if not RAKUTEN_APP_ID:
-        return {"error": "楽天APIキーが設定されていません"}
+def result_cache_key(api_params):
+    """検索結果キャッシュのキー（アプリケーションIDを除いたAPIパラメータ）"""
+    return json.dumps(
+        {key: value for key, value in api_params.items() if key != 'applicationId'},
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+
+def compact_hotel_results(results):
+    """楽天APIレスポンスを表示に必要な項目だけの共有用レコードに正規化
+
+    形式: {"pagingInfo": {...}, "hotels": ({"hotelBasicInfo": {...}, "roomInfo": [{"dailyCharge": {"total": ...}}]}, ...)}
+    """
+    hotels = []
+    for hotel_basic_info, room_info in normalize_hotel_results(results):
+        hotel = {'hotelBasicInfo': {key: hotel_basic_info[key] for key in RESULT_HOTEL_FIELDS if key in hotel_basic_info}}
+
+        # 料金情報（最初のdailyCharge.totalのみ）
+        if isinstance(room_info, list):
+            for room in room_info:
+                daily_charge = room.get('dailyCharge') if isinstance(room, dict) else None
+                if isinstance(daily_charge, dict) and 'total' in daily_charge:
+                    hotel['roomInfo'] = [{'dailyCharge': {'total': daily_charge['total']}}]
+                    break
+
+        hotels.append(hotel)
+
+    paging = results.get('pagingInfo') or {}
+    return {
+        'pagingInfo': {key: paging[key] for key in RESULT_PAGING_FIELDS if key in paging},
+        'hotels': tuple(hotels)
+    }
 
-    base_url = "https://app.rakuten.co.jp/services/api/Travel/VacantHotelSearch/20170426"
+def store_search_result(cache_key, result):
+    """検索結果を正規化して共有ストアに保存し、含まれるホテルを既知ホテルのインデックスに登録（ビューを返す）"""
+    record = compact_hotel_results(result)
+    store = get_result_store()
+    store.set(cache_key, record)
+    get_hotel_index().add_results(record)
+    suggester = get_location_suggester()
+    for hotel in record['hotels']:
+        suggester.add_hotel(hotel['hotelBasicInfo'])
+    return {'pagingInfo': record['pagingInfo'], 'hotels': list(record['hotels'])}
+
+def get_stale_result(cached, error_msg):
+    """上流障害時に期限切れのキャッシュ結果を返す（なければエラー）
+
+    cachedは検索開始時に共有ストアから取得した (経過秒数, 結果) またはNone
+    """
+    if cached is None:
+        return {"error": error_msg}
+    age, result = cached
+    return dict(result, degraded=f"{error_msg}（{int(age // 60)}分前のキャッシュ結果を表示しています）")
 
+def build_rakuten_api_params(params):
+    """検索パラメータから楽天APIの呼び出しパラメータを組み立てる"""
     # 必須パラメータの追加
     api_params = {
         'applicationId': RAKUTEN_APP_ID,
         'format': 'json',
-        'formatVersion': 1
+        'formatVersion': RAKUTEN_FORMAT_VERSION,
+        'elements': ','.join(RAKUTEN_RESPONSE_ELEMENTS)
     }
 
     # 検索パラメータの追加（内部情報は除外）
     for key, value in params.items():
-        if key not in ['coordinate_match', 'coordinate_failed']:
+        if key not in INTERNAL_PARAM_KEYS:
             api_params[key] = value
 
+    return api_params
+
+def search_rakuten_hotels(params, deadline=None):
+    """楽天トラベル空室検索APIを呼び出す（緯度経度ベース）"""
+    if not RAKUTEN_APP_ID:
+        return {"error": "楽天APIキーが設定されていません"}
+
+    base_url = RAKUTEN_VACANT_HOTEL_SEARCH_URL
+    api_params = build_rakuten_api_params(params)
+
+    cache_key = result_cache_key(api_params)
+
+    # キャッシュウォーマー等で取得済みの新しい結果があれば上流を呼ばない
+    # （障害時のフォールバックにも同じ取得結果を使い、ストアの参照は1検索1回にする）
+    cached = get_result_store().get(cache_key, max_age=STALE_RESULT_MAX_AGE_SECONDS)
+    if cached is not None and cached[0] <= RESULT_CACHE_TTL_SECONDS:
+        return cached[1]
+
+    breaker = get_circuit_breaker('rakuten')
+    timeout = request_timeout(deadline)
+
+    # 持ち時間切れ、またはブレーカーがオープン中の場合はキャッシュにフォールバック
+    # （持ち時間を先に判定し、上流を呼ばない場合にハーフオープンの試行枠を取らない）
+    if timeout < MIN_REQUEST_TIMEOUT:
+        return get_stale_result(cached, "検索がタイムアウトしました")
+    if not breaker.allow_request():
+        return get_stale_result(cached, "楽天APIが一時的に利用できません")
+
     # デバッグモードの場合、APIパラメータを表示
     if st.session_state.get('debug_mode', False):
         st.write("**楽天API呼び出しパラメータ:**")
@@ -316,7 +1177,8 @@ def search_rakuten_hotels(params):
         st.write(f"**API URL:** {base_url}")
 
     try:
-        response = requests.get(base_url, params=api_params)
+        get_rakuten_rate_limiter().record_call()
+        response = requests.get(base_url, params=api_params, timeout=timeout)
 
         # デバッグモードの場合、HTTPレスポンス情報を表示
         if st.session_state.get('debug_mode', False):
@@ -331,28 +1193,254 @@ def search_rakuten_hotels(params):
             st.write("**楽天API生レスポンス:**")
             st.json(result)
 
-        return result
+        breaker.record_success()
+        # セッションには生のレスポンスではなく共有ストアのビューを返す
+        return store_search_result(cache_key, result)
 
     except requests.exceptions.RequestException as e:
         error_msg = f"API呼び出しエラー: {str(e)}"
 
+        # 該当なし（404）などは上流障害ではないため、ブレーカーには数えない
+        if is_upstream_failure(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
         # デバッグモードの場合、詳細なエラー情報を表示
         if st.session_state.get('debug_mode', False):
             if hasattr(e, 'response') and e.response is not None:
                 st.write(f"**エラーレスポンス内容:** {e.response.text}")
 
+        if is_upstream_failure(e):
+            return get_stale_result(cached, error_msg)
         return {"error": error_msg}
 
+def query_key_from_params(params, location=None):
+    """検索パラメータから日付を除いたクエリキーを作成（人気クエリの集計用）"""
+    query = {key: params[key] for key in QUERY_KEY_PARAMS if params.get(key) is not None}
+    if location is None and 'coordinate_match' in params:
+        location = params['coordinate_match']['original_location']
+    if location:
+        query['location'] = normalize_location_key(location)
+    if 'location' not in query:
+        return None
+    return json.dumps(query, sort_keys=True, ensure_ascii=False)
+
+def record_search_traffic(params, location=None):
+    """対話的検索のクエリを記録（キャッシュウォーマーが人気クエリを学習する）"""
+    query_key = query_key_from_params(params, location)
+    if query_key:
+        get_query_traffic().record(query_key)
+
+def upcoming_weekend_windows(count, today=None):
+    """直近の週末（土曜チェックイン・1泊）の日付の組を返す"""
+    today = today or datetime.now().date()
+    saturday = today + timedelta(days=(5 - today.weekday()) % 7)
+    return [
+        (format_date_no_padding(saturday + timedelta(weeks=i)),
+         format_date_no_padding(saturday + timedelta(weeks=i, days=1)))
+        for i in range(count)
+    ]
+
+def warmer_query_keys():
+    """ウォームアップ対象のクエリキー（設定の地名 + 最近の人気クエリ）"""
+    query_keys = [
+        json.dumps({'location': normalize_location_key(name), 'adultNum': DEFAULT_ADULT_NUM, 'searchRadius': DEFAULT_SEARCH_RADIUS}, sort_keys=True, ensure_ascii=False)
+        for name in CACHE_WARMER_LOCATIONS
+    ]
+    for query_key in get_query_traffic().top(CACHE_WARMER_TOP_QUERIES):
+        if query_key not in query_keys:
+            query_keys.append(query_key)
+    return query_keys
+
+def refresh_rakuten_cache(params):
+    """楽天APIを呼び出して検索結果キャッシュを更新（画面表示なし、成功時True）"""
+    breaker = get_circuit_breaker('rakuten')
+    if not breaker.allow_request():
+        return False
+
+    api_params = build_rakuten_api_params(params)
+    try:
+        response = requests.get(RAKUTEN_VACANT_HOTEL_SEARCH_URL, params=api_params, timeout=DEFAULT_REQUEST_TIMEOUT)
+        response.raise_for_status()
+        result = response.json()
+    except requests.exceptions.RequestException as e:
+        if is_upstream_failure(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return False
+
+    breaker.record_success()
+    store_search_result(result_cache_key(api_params), result)
+    return True
+
+def warm_caches_once(stop_event):
+    """人気クエリ × 直近の週末について緯度経度と検索結果のキャッシュを更新"""
+    windows = upcoming_weekend_windows(CACHE_WARMER_WEEKENDS)
+    limiter = get_rakuten_rate_limiter()
+
+    for query_key in warmer_query_keys():
+        if stop_event.is_set():
+            return
+
+        # 緯度経度（キャッシュが期限切れの場合のみ上流を呼ぶ）
+        base_params = apply_coordinates_to_params(json.loads(query_key))
+        if 'latitude' not in base_params or 'longitude' not in base_params:
+            continue
+
+        for checkin_date, checkout_date in windows:
+            params = dict(base_params, checkinDate=checkin_date, checkoutDate=checkout_date)
+            cache_key = result_cache_key(build_rakuten_api_params(params))
+
+            # まだ新しいキャッシュは更新しない（有効期限の半分を過ぎたら更新）
+            age = get_result_store().age(cache_key)
+            if age is not None and age < RESULT_CACHE_TTL_SECONDS / 2:
+                continue
+
+            if not limiter.wait_for_background_slot(stop_event):
+                return
+            refresh_rakuten_cache(params)
+
+def run_cache_warmer(stop_event):
+    """キャッシュウォーマーのメインループ（バックグラウンドスレッドで実行）"""
+    while not stop_event.is_set():
+        try:
+            warm_caches_once(stop_event)
+        except Exception:
+            logger.exception("キャッシュウォーマー エラー")
+        stop_event.wait(CACHE_WARMER_INTERVAL_SECONDS)
+
+@st.cache_resource
+def start_cache_warmer():
+    """キャッシュウォーマーのスレッドを起動（プロセスごとに1つ）"""
+    if not CACHE_WARMER_ENABLED or not RAKUTEN_APP_ID:
+        return None
+
+    stop_event = threading.Event()
+    thread = threading.Thread(target=run_cache_warmer, args=(stop_event,), name="cache-warmer", daemon=True)
+    thread.start()
+    return stop_event
+
+def extract_hotel_info(hotel_data_item):
+    """ホテル情報を抽出する汎用関数"""
+    hotel_basic_info = None
+    room_info = None
+
+    # パターン1: hotelBasicInfo と roomInfo が直接存在
+    if isinstance(hotel_data_item, dict):
+        if 'hotelBasicInfo' in hotel_data_item:
+            hotel_basic_info = hotel_data_item['hotelBasicInfo']
+        if 'roomInfo' in hotel_data_item:
+            room_info = hotel_data_item['roomInfo']
+
+        # パターン2: hotel キーの下にhotelBasicInfo等が存在
+        if 'hotel' in hotel_data_item:
+            hotel_array = hotel_data_item['hotel']
+            if isinstance(hotel_array, list):
+                for item in hotel_array:
+                    if isinstance(item, dict):
+                        if 'hotelBasicInfo' in item:
+                            hotel_basic_info = item['hotelBasicInfo']
+                        if 'roomInfo' in item:
+                            room_info = item['roomInfo']
+            elif isinstance(hotel_array, dict):
+                if 'hotelBasicInfo' in hotel_array:
+                    hotel_basic_info = hotel_array['hotelBasicInfo']
+                if 'roomInfo' in hotel_array:
+                    room_info = hotel_array['roomInfo']
+
+        # パターン3: 直接ホテル情報が格納されている場合
+        if not hotel_basic_info and 'hotelName' in hotel_data_item:
+            hotel_basic_info = hotel_data_item
+
+    # パターン4: formatVersion=2 の構造: [{"hotelBasicInfo": ...}, {"roomInfo": ...}]
+    elif isinstance(hotel_data_item, list):
+        for item in hotel_data_item:
+            if isinstance(item, dict):
+                if 'hotelBasicInfo' in item:
+                    hotel_basic_info = item['hotelBasicInfo']
+                if 'roomInfo' in item:
+                    room_info = item['roomInfo']
+
+    return hotel_basic_info, room_info
+
+def normalize_hotel_results(results):
+    """楽天APIレスポンスから (hotelBasicInfo, roomInfo) の組のリストを取り出す（様々なデータ構造に対応）"""
+    hotels_data = results.get('hotels') if isinstance(results, dict) else None
+    entries = []
+
+    if isinstance(hotels_data, (list, tuple)):
+        # リスト形式（共有結果ストアのレコードはタプル）
+        # formatVersion=1（place.jsonの構造）: {"hotel": [{"hotelBasicInfo": ...}, {"roomInfo": ...}]}
+        # formatVersion=2: [{"hotelBasicInfo": ...}, {"roomInfo": ...}]
+        for hotel_data_item in hotels_data:
+            hotel_basic_info, room_info = extract_hotel_info(hotel_data_item)
+            if hotel_basic_info:
+                entries.append((hotel_basic_info, room_info))
+    elif isinstance(hotels_data, dict):
+        # 数値キーの辞書形式
+        numeric_keys = [k for k in hotels_data.keys() if str(k).isdigit()]
+        if numeric_keys:
+            # 数値キーでソート
+            sorted_keys = sorted(numeric_keys, key=lambda x: int(str(x)))
+
+            for key in sorted_keys:
+                hotel_data_item = hotels_data[key]
+
+                # リスト形式の場合、各要素を処理
+                if isinstance(hotel_data_item, list):
+                    for item in hotel_data_item:
+                        hotel_basic_info, room_info = extract_hotel_info(item)
+                        if hotel_basic_info:
+                            entries.append((hotel_basic_info, room_info))
+                            break  # 1つのホテルから1つの情報のみ取得
+                else:
+                    hotel_basic_info, room_info = extract_hotel_info(hotel_data_item)
+                    if hotel_basic_info:
+                        entries.append((hotel_basic_info, room_info))
+        else:
+            # 通常のキーを持つ辞書
+            for key, hotel_data_item in hotels_data.items():
+                hotel_basic_info, room_info = extract_hotel_info(hotel_data_item)
+                if hotel_basic_info:
+                    entries.append((hotel_basic_info, room_info))
+
+    return entries
+
+def show_nearby_known_hotels(params):
+    """楽天APIの応答を待つ間、既知ホテルのインデックスから近隣ホテルを表示（表示領域を返す）"""
+    placeholder = st.empty()
+    if params.get('latitude') is None or params.get('longitude') is None:
+        return placeholder
+
+    radius_km = params.get('searchRadius', 1)
+    nearby = get_hotel_index().nearby(params['latitude'], params['longitude'], radius_km, NEARBY_PREVIEW_LIMIT)
+    if not nearby:
+        return placeholder
+
+    with placeholder.container():
+        st.caption(f"📍 周辺の既知のホテル（{radius_km}km以内・空室確認中）")
+        for distance, hotel in nearby:
+            name = hotel.get('hotelName', '名前不明')
+            url = hotel.get('hotelInformationUrl', '')
+            label = f"[{name}]({url})" if url else name
+            st.markdown(f"- {label}（{distance:.1f}km）")
+    return placeholder
+
 def format_hotel_results(results):
     """ホテル検索結果をより見やすい形式で表示"""
     if "error" in results:
         st.error(f"❌ エラー: {results['error']}")
         return
 
-    # APIレスポンスの構造をデバッグ表示
+    if results.get('degraded'):
+        st.warning(f"⚠️ {results['degraded']}")
+
+    # 共有結果ストアの状態をデバッグ表示（レスポンス本体は楽天API呼び出し時に表示済み）
     if st.session_state.get('debug_mode', False):
-        st.write("**APIレスポンス構造（デバッグ）:**")
-        st.json(results)
+        st.write("**共有結果ストア（デバッグ）:**")
+        st.write(get_result_store().stats())
 
     if 'hotels' not in results or not results['hotels']:
         st.info("🔍 該当するホテルが見つかりませんでした。")
@@ -390,40 +1478,6 @@ def format_hotel_results(results):
         hotel_count = 0
         max_hotels = 100  # 最大表示数
 
-        def extract_hotel_info(hotel_data_item):
-            """ホテル情報を抽出する汎用関数"""
-            hotel_basic_info = None
-            room_info = None
-
-            # パターン1: hotelBasicInfo と roomInfo が直接存在
-            if isinstance(hotel_data_item, dict):
-                if 'hotelBasicInfo' in hotel_data_item:
-                    hotel_basic_info = hotel_data_item['hotelBasicInfo']
-                if 'roomInfo' in hotel_data_item:
-                    room_info = hotel_data_item['roomInfo']
-
-                # パターン2: hotel キーの下にhotelBasicInfo等が存在
-                if 'hotel' in hotel_data_item:
-                    hotel_array = hotel_data_item['hotel']
-                    if isinstance(hotel_array, list):
-                        for item in hotel_array:
-                            if isinstance(item, dict):
-                                if 'hotelBasicInfo' in item:
-                                    hotel_basic_info = item['hotelBasicInfo']
-                                if 'roomInfo' in item:
-                                    room_info = item['roomInfo']
-                    elif isinstance(hotel_array, dict):
-                        if 'hotelBasicInfo' in hotel_array:
-                            hotel_basic_info = hotel_array['hotelBasicInfo']
-                        if 'roomInfo' in hotel_array:
-                            room_info = hotel_array['roomInfo']
-
-                # パターン3: 直接ホテル情報が格納されている場合
-                if not hotel_basic_info and 'hotelName' in hotel_data_item:
-                    hotel_basic_info = hotel_data_item
-
-            return hotel_basic_info, room_info
-
         def format_single_hotel(hotel_basic_info, room_info, index):
             """単一ホテルの情報を見やすいカード形式でフォーマット"""
             if not hotel_basic_info:
@@ -518,64 +1572,10 @@ def format_hotel_results(results):
                 st.divider()
 
         # 様々なデータ構造に対応
-        if isinstance(hotels_data, list):
-            # リスト形式
-            for hotel_data_item in hotels_data:
-                # place.jsonの構造: {"hotel": [{"hotelBasicInfo": ...}, {"roomInfo": ...}]}
-                if isinstance(hotel_data_item, dict) and 'hotel' in hotel_data_item:
-                    hotel_array = hotel_data_item['hotel']
-                    if isinstance(hotel_array, list):
-                        hotel_basic_info = None
-                        room_info = None
-
-                        # hotel配列から情報を抽出
-                        for item in hotel_array:
-                            if isinstance(item, dict):
-                                if 'hotelBasicInfo' in item:
-                                    hotel_basic_info = item['hotelBasicInfo']
-                                if 'roomInfo' in item:
-                                    room_info = item['roomInfo']
-
-                        if hotel_basic_info:
-                            hotel_count += 1
-                            format_single_hotel(hotel_basic_info, room_info, hotel_count)
-                else:
-                    # 従来の処理（後方互換性のため）
-                    hotel_basic_info, room_info = extract_hotel_info(hotel_data_item)
-                    if hotel_basic_info:
-                        hotel_count += 1
-                        format_single_hotel(hotel_basic_info, room_info, hotel_count)
-        elif isinstance(hotels_data, dict):
-            # 数値キーの辞書形式
-            numeric_keys = [k for k in hotels_data.keys() if str(k).isdigit()]
-            if numeric_keys:
-                # 数値キーでソート
-                sorted_keys = sorted(numeric_keys, key=lambda x: int(str(x)))
-
-                for key in sorted_keys:
-                    hotel_data_item = hotels_data[key]
-
-                    # リスト形式の場合、各要素を処理
-                    if isinstance(hotel_data_item, list):
-                        for item in hotel_data_item:
-                            hotel_basic_info, room_info = extract_hotel_info(item)
-                            if hotel_basic_info:
-                                hotel_count += 1
-                                format_single_hotel(hotel_basic_info, room_info, hotel_count)
-                                break  # 1つのホテルから1つの情報のみ取得
-                    else:
-                        hotel_basic_info, room_info = extract_hotel_info(hotel_data_item)
-                        if hotel_basic_info:
-                            hotel_count += 1
-                            format_single_hotel(hotel_basic_info, room_info, hotel_count)
-            else:
-                # 通常のキーを持つ辞書
-                for key, hotel_data_item in hotels_data.items():
-                    hotel_basic_info, room_info = extract_hotel_info(hotel_data_item)
-                    if hotel_basic_info:
-                        hotel_count += 1
-                        format_single_hotel(hotel_basic_info, room_info, hotel_count)
-
+        if isinstance(hotels_data, (list, dict)):
+            for hotel_basic_info, room_info in normalize_hotel_results(results):
+                hotel_count += 1
+                format_single_hotel(hotel_basic_info, room_info, hotel_count)
         else:
             st.error(f"❌ 未対応のホテルデータ構造: {type(hotels_data)}")
 
@@ -617,6 +1617,12 @@ def main():
         st.error("⚠️ 楽天APIキーが設定されていません。.env ファイルに RAKUTEN_APP_ID を設定してください。")
         st.info("楽天ウェブサービスから Application ID を取得してください: https://webservice.rakuten.co.jp/")
     else:
+        # 人気の地名・直近の週末の検索結果をバックグラウンドで事前取得
+        start_cache_warmer()
+
+        # 入力候補のインデックスは検索の持ち時間を使わないよう画面表示時に構築
+        get_location_suggester()
+
         # ホテル検索フォーム
         st.subheader("🔍 ホテル検索")
 
@@ -629,11 +1635,12 @@ def main():
 
         if st.button("🔍 ホテルを検索") and search_query:
             with st.spinner("ホテルを検索中..."):
-                if not openai.api_key:
-                    st.error("⚠️ AI解析にはOpenAI APIキーが必要です")
-                    params = {}
-                else:
-                    params = parse_travel_request_with_openai(search_query)
+                # 解析・緯度経度取得・検索の全体に締め切りを設ける
+                deadline = Deadline(SEARCH_DEADLINE_SECONDS)
+                params = parse_travel_request(search_query, deadline)
+
+                if params.get('parser') == 'local':
+                    st.info("ℹ️ AI解析が利用できないため、簡易解析で検索条件を抽出しました")
 
                 # エラーチェック
                 if "error" in params:
@@ -664,8 +1671,11 @@ def main():
                     with st.expander("🔧 検索パラメータ（デバッグ用）"):
                         st.json(params)
 
-                    # 楽天 API 呼び出し
-                    results = search_rakuten_hotels(params)
+                    # 楽天 API 呼び出し（応答待ちの間は既知の近隣ホテルを表示）
+                    record_search_traffic(params)
+                    preview = show_nearby_known_hotels(params)
+                    results = search_rakuten_hotels(params, deadline.stage('search'))
+                    preview.empty()
 
                     # 結果表示
                     format_hotel_results(results)
@@ -695,7 +1705,7 @@ def main():
 
             with col1:
                 checkin = st.date_input("チェックイン日")
-                adult_num = st.number_input("大人数", min_value=1, max_value=10, value=2)
+                adult_num = st.number_input("大人数", min_value=1, max_value=10, value=DEFAULT_ADULT_NUM)
 
             with col2:
                 nights = st.number_input("泊数", min_value=1, max_value=30, value=1)
@@ -707,14 +1717,30 @@ def main():
                 help="AIが地名から日本測地系の緯度経度（秒単位）を取得して位置ベース検索を行います"
             )
 
+            # 過去に検索した地名・既知のホテルから入力候補を表示（選ぶと緯度経度の取得を省略）
+            suggestions = get_location_suggester().suggest(location_input) if location_input else []
+            selected_suggestion = None
+            if suggestions:
+                suggestion_index = st.selectbox(
+                    "入力候補",
+                    range(len(suggestions) + 1),
+                    format_func=lambda i: "入力した地域名で検索" if i == 0 else
+                        f"{'📍' if suggestions[i - 1]['kind'] == 'place' else '🏨'} {suggestions[i - 1]['label']}",
+                    help="候補を選ぶと保存済みの緯度経度で検索します"
+                )
+                if suggestion_index:
+                    selected_suggestion = suggestions[suggestion_index - 1]
+
             search_radius = st.selectbox(
                 "検索半径",
                 [1, 2, 3],
-                index=0,
+                index=[1, 2, 3].index(DEFAULT_SEARCH_RADIUS),
                 help="指定地点から何km以内で検索するか"
             )
 
             if st.button("詳細検索を実行"):
+                deadline = Deadline(SEARCH_DEADLINE_SECONDS)
+
                 # 詳細検索パラメータの構築
                 detail_params = {
                     'checkinDate': format_date_no_padding(checkin),
@@ -727,8 +1753,11 @@ def main():
                     detail_params['maxCharge'] = max_charge
 
                 # AI緯度経度選択
-                if location_input and openai.api_key:
-                    coordinates = get_coordinates_from_location(location_input)
+                if location_input:
+                    if selected_suggestion:
+                        coordinates = dict(selected_suggestion, source='suggestion')
+                    else:
+                        coordinates = get_coordinates_from_location(location_input, deadline.stage('geocode'))
                     if coordinates and 'latitude' in coordinates and 'longitude' in coordinates:
                         # 緯度経度をミリ秒小数点以下2桁まで丸める
                         lat_val = coordinates['latitude']
@@ -745,6 +1774,9 @@ def main():
                             elif source == 'openai':
                                 source_emoji = "🤖"
                                 source_text = "OpenAI"
+                            elif source == 'suggestion':
+                                source_emoji = "📌"
+                                source_text = "入力候補"
                             else:
                                 source_emoji = "❓"
                                 source_text = "不明"
@@ -758,7 +1790,14 @@ def main():
                         st.warning(f"⚠️ 地域「{location_input}」の緯度経度選択に失敗しました")
 
                 with st.spinner("詳細検索を実行中..."):
-                    results = search_rakuten_hotels(detail_params)
+                    # ホテル名の候補を選んだ場合は地名ではないため人気クエリに数えない
+                    if not selected_suggestion:
+                        record_search_traffic(detail_params, location_input)
+                    elif selected_suggestion['kind'] == 'place':
+                        record_search_traffic(detail_params, selected_suggestion['label'])
+                    preview = show_nearby_known_hotels(detail_params)
+                    results = search_rakuten_hotels(detail_params, deadline.stage('search'))
+                    preview.empty()
                     format_hotel_results(results)
 
     # サイドバーにコントロール
@@ -0,0 +1,459 @@
+"""
+ホテル検索フローの負荷試験ツール
+
+OpenAI・Google Geocoding・楽天トラベルAPIを模したローカルのスタブサーバーを起動し、
+N個の同時セッションで app.py の実際の検索フロー
+（条件解析 → 緯度経度取得 → search_rakuten_hotels → 結果の正規化・表示）を繰り返し実行します。
+スループット、レイテンシ（p50/p99）、メモリ増加、スレッド数を集計して表示します。
+
+使用例:
+    python loadtest.py --sessions 20 --searches 10
+    python loadtest.py --sessions 50 --duration 60 --rakuten-latency-ms 800 --rakuten-error-rate 0.2
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# スタブの楽天APIが返すサンプルレスポンス
+SAMPLE_RESPONSE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'place.json')
+
+# 検索クエリに使う地名
+DEFAULT_LOCATIONS = ['東京', '大阪', '京都', '箱根', '熱海', '新宿駅', '銀座', '札幌駅', '那覇空港']
+
+# スタブのGoogle Geocoding APIが返す座標（WGS84・度単位、東京駅付近）
+STUB_WGS84_LOCATION = {'lat': 35.681236, 'lng': 139.767125}
+
+def percentile(values, percent):
+    """値のリストのパーセンタイル（最近傍順位法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(percent / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+def current_rss_mb():
+    """現在の常駐メモリ（MB、取得できない場合はNone）"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def peak_rss_mb():
+    """プロセス開始からの最大常駐メモリ（MB、取得できない場合はNone）"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト単位
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+def project_elements(value, elements):
+    """楽天APIのelements指定を模して、指定された項目だけを残す"""
+    if isinstance(value, dict):
+        return {
+            key: project_elements(item, elements)
+            for key, item in value.items()
+            if isinstance(item, (dict, list)) or key in elements
+        }
+    if isinstance(value, list):
+        return [project_elements(item, elements) for item in value]
+    return value
+
+class StubUpstreams:
+    """OpenAI・Google Geocoding・楽天APIを模したローカルHTTPサーバー（遅延・エラー率を設定可能）"""
+
+    def __init__(self, latency_ms, error_rate, parse_query, jitter=0.2, seed=None):
+        self.latency_ms = latency_ms
+        self.parse_query = parse_query
+        self.error_rate = error_rate
+        self.jitter = jitter
+        self.request_counts = {'openai': 0, 'google': 0, 'rakuten': 0}
+        self.error_counts = {'openai': 0, 'google': 0, 'rakuten': 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._rakuten_bodies = {}
+        with open(SAMPLE_RESPONSE_PATH, 'r', encoding='utf-8') as f:
+            self._sample = json.load(f)
+        self._server = None
+
+    def start(self):
+        """サーバーをバックグラウンドで起動してベースURLを返す"""
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.handle(self, 'GET')
+
+            def do_POST(self):
+                stub.handle(self, 'POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='stub-upstreams', daemon=True).start()
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _simulate(self, upstream):
+        """設定された遅延を待ち、エラーにするかどうかを決める"""
+        with self._lock:
+            self.request_counts[upstream] += 1
+            delay = max(0.0, self._random.gauss(self.latency_ms[upstream], self.latency_ms[upstream] * self.jitter))
+            failed = self._random.random() < self.error_rate[upstream]
+            if failed:
+                self.error_counts[upstream] += 1
+        time.sleep(delay / 1000)
+        return failed
+
+    def handle(self, request, method):
+        url = urlparse(request.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if method == 'GET' and url.path == '/rakuten':
+            upstream = 'rakuten'
+        elif method == 'GET' and url.path == '/geocode':
+            upstream = 'google'
+        elif method == 'POST' and url.path.endswith('/chat/completions'):
+            upstream = 'openai'
+        else:
+            self._send(request, 404, {'error': 'not_found'})
+            return
+
+        body = None
+        if method == 'POST':
+            length = int(request.headers.get('Content-Length', 0))
+            body = json.loads(request.rfile.read(length) or b'{}')
+
+        if self._simulate(upstream):
+            self._send(request, 503, {'error': {'message': 'stub upstream error', 'type': 'server_error'}})
+            return
+
+        if upstream == 'rakuten':
+            self._send_raw(request, 200, self._rakuten_body(query))
+        elif upstream == 'google':
+            self._send(request, 200, {
+                'status': 'OK',
+                'results': [{
+                    'geometry': {'location': STUB_WGS84_LOCATION},
+                    'formatted_address': f"日本、{query.get('address', '').replace(', Japan', '')}"
+                }]
+            })
+        else:
+            self._send(request, 200, self._chat_completion(body))
+
+    def _rakuten_body(self, query):
+        """formatVersion・elementsに応じたレスポンス（生成済みのものを再利用）"""
+        cache_key = (query.get('formatVersion', '1'), query.get('elements', ''))
+        with self._lock:
+            if cache_key not in self._rakuten_bodies:
+                response = self._sample
+                if cache_key[0] == '2':
+                    response = {
+                        'pagingInfo': response['pagingInfo'],
+                        'hotels': [item['hotel'] for item in response['hotels']]
+                    }
+                if cache_key[1]:
+                    response = project_elements(response, set(cache_key[1].split(',')))
+                self._rakuten_bodies[cache_key] = json.dumps(response, ensure_ascii=False).encode('utf-8')
+            return self._rakuten_bodies[cache_key]
+
+    def _chat_completion(self, body):
+        """OpenAI ChatCompletionの応答（条件解析は簡易解析の結果を返す）"""
+        user_text = body['messages'][-1]['content'].split(': ', 1)[-1]
+        if body.get('functions'):
+            params = self.parse_query(user_text)
+            params.pop('parser', None)
+            message = {
+                'role': 'assistant',
+                'content': None,
+                'function_call': {'name': 'search_rakuten_hotels', 'arguments': json.dumps(params, ensure_ascii=False)}
+            }
+        else:
+            message = {
+                'role': 'assistant',
+                'content': json.dumps({'latitude': 128440.51, 'longitude': 503172.21, 'location_name': user_text}, ensure_ascii=False)
+            }
+        return {
+            'id': 'chatcmpl-loadtest',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'stub'),
+            'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+        }
+
+    def _send(self, request, status, payload):
+        self._send_raw(request, status, json.dumps(payload, ensure_ascii=False).encode('utf-8'))
+
+    def _send_raw(self, request, status, data):
+        try:
+            request.send_response(status)
+            request.send_header('Content-Type', 'application/json; charset=utf-8')
+            request.send_header('Content-Length', str(len(data)))
+            request.end_headers()
+            request.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # 締め切りでクライアントが先に切断した場合
+            pass
+
+class ThreadSampler:
+    """実行中のスレッド数を定期的に記録"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='thread-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+def build_queries(locations, count, rng):
+    """自然言語の検索クエリを作成（地名 × 日付 × 人数の組み合わせ）"""
+    today = datetime.now().date()
+    queries = []
+    for _ in range(count):
+        checkin = today + timedelta(days=rng.randint(1, 30))
+        queries.append(
+            f"{rng.choice(locations)}に{checkin.month}月{checkin.day}日から{rng.randint(1, 2)}泊、"
+            f"大人{rng.randint(1, 4)}名で泊まれるホテル"
+        )
+    return queries
+
+def run_search(app, query):
+    """main()のホテル検索と同じ手順で1回検索する（結果の種別と各ステージの所要時間を返す）"""
+    started = time.perf_counter()
+    deadline = app.Deadline(app.SEARCH_DEADLINE_SECONDS)
+    params = app.parse_travel_request(query, deadline)
+    parsed = time.perf_counter()
+
+    if "error" in params:
+        return 'error', parsed - started, 0.0, 0.0, params.get('parser')
+
+    app.record_search_traffic(params)
+    preview = app.show_nearby_known_hotels(params)
+    results = app.search_rakuten_hotels(params, deadline.stage('search'))
+    preview.empty()
+    searched = time.perf_counter()
+
+    app.format_hotel_results(results)
+    rendered = time.perf_counter()
+
+    if "error" in results:
+        outcome = 'error'
+    elif results.get('degraded'):
+        outcome = 'degraded'
+    else:
+        outcome = 'ok'
+    return outcome, parsed - started, searched - parsed, rendered - searched, params.get('parser')
+
+def run_session(app, queries, args, seed, stop_at, samples, samples_lock):
+    """1セッション分の検索を繰り返す"""
+    rng = random.Random(seed)
+    for _ in range(args.searches):
+        if time.monotonic() >= stop_at:
+            break
+        query = rng.choice(queries)
+        started = time.perf_counter()
+        try:
+            outcome, parse_time, search_time, render_time, parser = run_search(app, query)
+        except Exception as e:
+            outcome, parse_time, search_time, render_time, parser = f"exception: {type(e).__name__}", 0.0, 0.0, 0.0, None
+        total = time.perf_counter() - started
+        with samples_lock:
+            samples.append({
+                'outcome': outcome,
+                'parser': parser or 'openai',
+                'total': total,
+                'parse': parse_time,
+                'search': search_time,
+                'render': render_time
+            })
+        if args.think_ms:
+            time.sleep(rng.uniform(0.5, 1.5) * args.think_ms / 1000)
+
+def summarize(samples, elapsed, args, stub, app, memory, threads):
+    """集計結果の辞書を作成"""
+    outcomes = {}
+    parsers = {}
+    for sample in samples:
+        outcomes[sample['outcome']] = outcomes.get(sample['outcome'], 0) + 1
+        parsers[sample['parser']] = parsers.get(sample['parser'], 0) + 1
+
+    def latency(key):
+        values = [sample[key] * 1000 for sample in samples]
+        return {
+            'p50_ms': round(percentile(values, 50), 1),
+            'p99_ms': round(percentile(values, 99), 1),
+            'max_ms': round(max(values), 1) if values else 0.0
+        }
+
+    return {
+        'sessions': args.sessions,
+        'searches': len(samples),
+        'elapsed_seconds': round(elapsed, 2),
+        'throughput_per_second': round(len(samples) / elapsed, 2) if elapsed > 0 else 0.0,
+        'latency': {key: latency(key) for key in ('total', 'parse', 'search', 'render')},
+        'outcomes': outcomes,
+        'parsers': parsers,
+        'upstream_requests': dict(stub.request_counts),
+        'upstream_errors': dict(stub.error_counts),
+        'circuit_breakers': {name: app.get_circuit_breaker(name).state for name in ('openai', 'google', 'rakuten')},
+        'result_store': app.get_result_store().stats(),
+        'cache_entries': {
+            'geocode': len(app.get_geocode_cache().items()),
+            'known_hotels': len(app.get_hotel_index())
+        },
+        'memory': memory,
+        'threads': threads
+    }
+
+def print_report(report):
+    print(f"セッション数: {report['sessions']}  検索回数: {report['searches']}  経過時間: {report['elapsed_seconds']}秒")
+    print(f"スループット: {report['throughput_per_second']} 検索/秒")
+    print("レイテンシ:")
+    for key, label in (('total', '全体'), ('parse', '解析+緯度経度'), ('search', '楽天API'), ('render', '表示')):
+        values = report['latency'][key]
+        print(f"  {label}: p50={values['p50_ms']}ms  p99={values['p99_ms']}ms  max={values['max_ms']}ms")
+    print(f"結果: {report['outcomes']}  解析: {report['parsers']}")
+    print(f"上流リクエスト: {report['upstream_requests']}  上流エラー: {report['upstream_errors']}")
+    print(f"サーキットブレーカー: {report['circuit_breakers']}")
+    print(f"共有結果ストア: {report['result_store']}")
+    print(f"キャッシュ件数: {report['cache_entries']}")
+    print(f"メモリ: {report['memory']}")
+    print(f"スレッド: {report['threads']}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="スタブの上流APIに対してホテル検索フローの負荷試験を行う")
+    parser.add_argument('--sessions', type=int, default=10, help="同時セッション数")
+    parser.add_argument('--searches', type=int, default=10, help="1セッションあたりの検索回数")
+    parser.add_argument('--duration', type=float, default=None, help="試験時間の上限（秒）")
+    parser.add_argument('--think-ms', type=float, default=0, help="検索間の平均待ち時間（ミリ秒）")
+    parser.add_argument('--distinct-queries', type=int, default=50, help="検索クエリの種類数")
+    parser.add_argument('--locations', default=','.join(DEFAULT_LOCATIONS), help="クエリに使う地名（カンマ区切り）")
+    parser.add_argument('--deadline', type=float, default=None, help="検索全体の締め切り（秒、省略時はアプリの設定）")
+    parser.add_argument('--no-cache', action='store_true', help="検索結果・緯度経度のキャッシュを使わない")
+    parser.add_argument('--jitter', type=float, default=0.2, help="遅延のばらつき（平均に対する標準偏差の比）")
+    for upstream, latency in (('openai', 800), ('google', 150), ('rakuten', 400)):
+        parser.add_argument(f'--{upstream}-latency-ms', type=float, default=latency, help=f"{upstream}スタブの平均遅延（ミリ秒）")
+        parser.add_argument(f'--{upstream}-error-rate', type=float, default=0.0, help=f"{upstream}スタブのエラー率（0〜1）")
+    parser.add_argument('--tracemalloc', action='store_true', help="Pythonヒープの増加量も計測する（計測負荷あり）")
+    parser.add_argument('--seed', type=int, default=0, help="乱数シード")
+    parser.add_argument('--json', action='store_true', help="結果をJSONで出力する")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # アプリの読み込み前に、キーと保存先をスタブ用に設定（.envより優先）
+    os.environ.update({
+        'RAKUTEN_APP_ID': 'loadtest',
+        'OPENAI_API_KEY': 'loadtest',
+        'GOOGLE_GEOCODING_API_KEY': 'loadtest',
+        'KNOWN_HOTELS_PATH': '',
+        'CACHE_WARMER_ENABLED': '0'
+    })
+    import openai
+    import app
+
+    # Streamlitの実行環境外（bare mode）で呼び出すことによる警告を抑制
+    logging.disable(logging.WARNING)
+
+    stub = StubUpstreams(
+        latency_ms={'openai': args.openai_latency_ms, 'google': args.google_latency_ms, 'rakuten': args.rakuten_latency_ms},
+        error_rate={'openai': args.openai_error_rate, 'google': args.google_error_rate, 'rakuten': args.rakuten_error_rate},
+        parse_query=app.parse_travel_request_locally,
+        jitter=args.jitter,
+        seed=args.seed
+    )
+    base_url = stub.start()
+    openai.api_base = f"{base_url}/v1"
+    app.RAKUTEN_VACANT_HOTEL_SEARCH_URL = f"{base_url}/rakuten"
+    app.GOOGLE_GEOCODING_URL = f"{base_url}/geocode"
+    if args.deadline is not None:
+        app.SEARCH_DEADLINE_SECONDS = args.deadline
+    if args.no_cache:
+        app.RESULT_CACHE_TTL_SECONDS = 0
+        app.GEOCODE_CACHE_TTL_SECONDS = 0
+
+    rng = random.Random(args.seed)
+    queries = build_queries([name for name in args.locations.split(',') if name], args.distinct_queries, rng)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    rss_start = current_rss_mb()
+    threads_start = threading.active_count()
+    sampler = ThreadSampler()
+    sampler.start()
+
+    samples = []
+    samples_lock = threading.Lock()
+    started = time.monotonic()
+    stop_at = started + args.duration if args.duration else float('inf')
+    with ThreadPoolExecutor(max_workers=args.sessions, thread_name_prefix='session') as executor:
+        futures = [
+            executor.submit(run_session, app, queries, args, args.seed + i, stop_at, samples, samples_lock)
+            for i in range(args.sessions)
+        ]
+        for future in futures:
+            future.result()
+    elapsed = time.monotonic() - started
+
+    sampler.stop()
+    rss_end = current_rss_mb()
+    memory = {
+        'rss_start_mb': None if rss_start is None else round(rss_start, 1),
+        'rss_end_mb': None if rss_end is None else round(rss_end, 1),
+        'rss_growth_mb': None if rss_start is None or rss_end is None else round(rss_end - rss_start, 1),
+        'rss_peak_mb': None if peak_rss_mb() is None else round(peak_rss_mb(), 1)
+    }
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory['python_heap_growth_mb'] = round(current / 1024 / 1024, 1)
+        memory['python_heap_peak_mb'] = round(peak / 1024 / 1024, 1)
+    threads = {'start': threads_start, 'peak': sampler.peak, 'end': threading.active_count()}
+
+    report = summarize(samples, elapsed, args, stub, app, memory, threads)
+    stub.stop()
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    return report
+
+if __name__ == "__main__":
+    main()